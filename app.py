@@ -7,20 +7,32 @@ Uses VictoriaMetrics for time-series storage.
 
 import os
 import json
+import time
+import tempfile
+import sqlite3
+import functools
+import threading
 from datetime import datetime
-from io import BytesIO
+from types import MappingProxyType
 
+import ijson
 import requests
 import tinytuya
+import xlsxwriter
+import numpy as np
 import pandas as pd
-from flask import Flask, render_template, jsonify, send_file, request
+from dateutil.tz import tzlocal
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, render_template, jsonify, send_file, request, after_this_request
 
 app = Flask(__name__)
 
 # Load configuration
 CONFIG_FILE = os.path.join(os.path.dirname(__file__), "config.json")
 PRESETS_FILE = os.path.join(os.path.dirname(__file__), "tank_presets.json")
-DIARY_FILE = os.path.join(os.path.dirname(__file__), "diary.json")
+DIARY_DB = os.path.join(os.path.dirname(__file__), "diary.db")
+DIARY_FILE = os.path.join(os.path.dirname(__file__), "diary.json")  # Legacy, imported into DIARY_DB
 
 if os.path.exists(CONFIG_FILE):
     with open(CONFIG_FILE) as f:
@@ -30,6 +42,7 @@ if os.path.exists(CONFIG_FILE):
     LOCAL_KEY = config.get("local_key", "")
     VERSION = config.get("protocol_version", 3.5)
     TANK_TYPE = config.get("tank_type", "freshwater_tropical")
+    FLUSH_CYCLES = config.get("flush_cycles", 1)
 else:
     # Fallback to hardcoded values (for backwards compatibility)
     DEVICE_ID = "bfe0cad26f6fbd00c8v7dn"
@@ -37,19 +50,28 @@ else:
     LOCAL_KEY = "v.X0.aJ~eBK/5ruE"
     VERSION = 3.5
     TANK_TYPE = "freshwater_tropical"
+    FLUSH_CYCLES = 1
 
-# Load tank presets
+# Load tank presets once; read-only since responses derived from them are cached
 if os.path.exists(PRESETS_FILE):
     with open(PRESETS_FILE) as f:
-        TANK_PRESETS = json.load(f)
+        TANK_PRESETS = MappingProxyType(json.load(f))
 else:
-    TANK_PRESETS = {}
+    TANK_PRESETS = MappingProxyType({})
 
 # VictoriaMetrics configuration
 VM_URL = "http://localhost:8428"
 
+# Shared session so VictoriaMetrics queries reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.2),
+))
+
 # DPS mappings
-DPS_MAP = {
+DPS_MAP = MappingProxyType({
     "8": ("temperature", "Temperature", "°C", 0.1),
     "106": ("ph", "pH", "", 0.01),
     "111": ("tds", "TDS", "ppm", 1),
@@ -57,10 +79,10 @@ DPS_MAP = {
     "121": ("salinity", "Salinity", "ppm", 1),
     "126": ("sg", "Specific Gravity", "", 0.001),
     "131": ("orp", "ORP", "mV", 1),
-}
+})
 
 # VictoriaMetrics metric names
-VM_METRICS = {
+VM_METRICS = MappingProxyType({
     "temperature": "aquarium_temperature_celsius",
     "ph": "aquarium_ph",
     "tds": "aquarium_tds_ppm",
@@ -68,11 +90,62 @@ VM_METRICS = {
     "salinity": "aquarium_salinity_ppm",
     "sg": "aquarium_specific_gravity",
     "orp": "aquarium_orp_mv",
-}
-
-
-def get_sensor_reading():
-    """Fetch current reading from the aquarium sensor."""
+})
+
+# Longest history range served (the dashboard's 1y view), bounding query size
+MAX_HISTORY_HOURS = 24 * 366
+
+# Reverse lookup: VictoriaMetrics metric name -> short column name
+VM_COLUMNS = MappingProxyType({metric: col for col, metric in VM_METRICS.items()})
+
+# Selects every aquarium series so one request returns all metrics
+ALL_METRICS_QUERY = '{__name__=~"aquarium_.*"}'
+
+# Latest sample of every series. The collector writes every flush_cycles
+# 5-minute cycles (and at least hourly), so look back that far plus two
+# cycles to tolerate a missed collection: 15m with the default of 1
+COLLECT_INTERVAL_MINUTES = 5
+LATEST_LOOKBACK_MINUTES = (min(FLUSH_CYCLES, 12) + 2) * COLLECT_INTERVAL_MINUTES
+LATEST_METRICS_QUERY = (
+    f'last_over_time({{__name__=~"aquarium_.*"}}[{LATEST_LOOKBACK_MINUTES}m]) keep_metric_names'
+)
+
+# 7-day mean of each metric whose safe range adapts to local conditions
+WEEKLY_MEANS_QUERY = (
+    'avg_over_time({__name__=~"'
+    + "|".join(VM_METRICS[col] for col in ("ph", "ec", "tds", "salinity", "orp"))
+    + '"}[7d]) keep_metric_names'
+)
+
+
+def ttl_cache(seconds, cache_if=None):
+    """Cache a function's result per argument tuple for the given number of seconds.
+
+    If given, cache_if(value) decides whether a result is worth keeping, so a
+    failed lookup is retried on the next call instead of being served stale.
+    """
+    def decorator(func):
+        cache = {}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            now = time.monotonic()
+            with lock:
+                hit = cache.get(args)
+                if hit and now - hit[0] < seconds:
+                    return hit[1]
+            value = func(*args)
+            if cache_if is None or cache_if(value):
+                with lock:
+                    cache[args] = (now, value)
+            return value
+        return wrapper
+    return decorator
+
+
+def read_device():
+    """Fetch a live reading directly from the aquarium sensor."""
     try:
         d = tinytuya.Device(DEVICE_ID, DEVICE_IP, LOCAL_KEY, version=VERSION)
         d.set_socketTimeout(5)
@@ -92,80 +165,129 @@ def get_sensor_reading():
         return None, str(e)
 
 
-def query_victoria(metric, hours):
-    """Query VictoriaMetrics for time-series data."""
+@ttl_cache(10, cache_if=lambda result: result[0] is not None)
+def read_latest():
+    """Latest reading stored by the collector in VictoriaMetrics."""
+    reading = query_victoria_instant(LATEST_METRICS_QUERY)
+    if not reading:
+        return None, "No recent readings in VictoriaMetrics"
+    return reading, None
+
+
+def get_sensor_reading(live=False):
+    """Get the current reading.
+
+    Serves the collector's latest sample from VictoriaMetrics so page loads
+    don't wait on the sensor; pass live=True to query the device directly.
+    """
+    if live:
+        return read_device()
+    return read_latest()
+
+
+def query_victoria_instant(query):
+    """Run an instant query and return a dict of short column name -> value."""
+    try:
+        resp = SESSION.get(
+            f"{VM_URL}/api/v1/query",
+            params={"query": query, "latency_offset": "1s"},
+            timeout=10
+        )
+        data = resp.json()
+
+        values = {}
+        if data.get("status") == "success":
+            for result in data["data"]["result"]:
+                col = VM_COLUMNS.get(result["metric"].get("__name__"))
+                value = float(result["value"][1])
+                if col is not None and col not in values and np.isfinite(value):
+                    values[col] = value
+        return values
+    except Exception as e:
+        app.logger.error(f"VictoriaMetrics query failed: {e}")
+        return {}
+
+
+def query_step(hours):
+    """Pick a query step giving reasonable data density for the time range."""
+    if hours <= 6:
+        return "1m"
+    elif hours <= 24:
+        return "5m"
+    elif hours <= 168:  # 7 days
+        return "15m"
+    return "1h"
+
+
+def query_victoria_multi(hours, step=None, timeout=10):
+    """Query VictoriaMetrics for all aquarium series in a single request.
+
+    Returns a dict keyed by short column name (see VM_METRICS), each holding
+    float64 arrays of the unix timestamps and values for that series.
+    """
     try:
-        # Calculate step based on time range for reasonable data density
-        if hours <= 6:
-            step = "1m"
-        elif hours <= 24:
-            step = "5m"
-        elif hours <= 168:  # 7 days
-            step = "15m"
-        else:
-            step = "1h"
-
-        resp = requests.get(
+        resp = SESSION.get(
             f"{VM_URL}/api/v1/query_range",
             params={
-                "query": metric,
+                "query": ALL_METRICS_QUERY,
                 "start": f"-{hours}h",
                 "end": "now",
-                "step": step,
+                "step": step or query_step(hours),
+                "latency_offset": "1s",  # Include just-written samples
             },
-            timeout=10
+            timeout=timeout,
+            stream=True
         )
-        data = resp.json()
 
-        if data["status"] == "success" and data["data"]["result"]:
-            result = data["data"]["result"][0]
-            values = result["values"]
-            return {
-                "timestamps": [datetime.fromtimestamp(v[0]).strftime("%Y-%m-%d %H:%M:%S") for v in values],
-                "values": [float(v[1]) for v in values],
-            }
-        return {"timestamps": [], "values": []}
+        series = {}
+        with resp:
+            if resp.status_code != 200:
+                app.logger.error(f"VictoriaMetrics query failed: HTTP {resp.status_code}")
+                return series
+
+            # Parse one series at a time rather than loading the whole response
+            resp.raw.decode_content = True
+            for result in ijson.items(resp.raw, "data.result.item", use_float=True):
+                col = VM_COLUMNS.get(result["metric"].get("__name__"))
+                if col is None or col in series:
+                    continue
+                values = result["values"]
+                series[col] = {
+                    "timestamps": np.fromiter((v[0] for v in values), dtype=np.float64, count=len(values)),
+                    "values": np.fromiter((float(v[1]) for v in values), dtype=np.float64, count=len(values)),
+                }
+        return series
     except Exception as e:
         app.logger.error(f"VictoriaMetrics query failed: {e}")
-        return {"timestamps": [], "values": []}
+        return {}
+
 
+def to_local_datetimes(timestamps):
+    """Convert unix timestamps to naive local-time datetimes in one vectorized pass."""
+    return pd.to_datetime(timestamps, unit="s", utc=True).tz_convert(tzlocal()).tz_localize(None)
 
+
+@ttl_cache(60, cache_if=lambda df: not df.empty)
 def get_all_readings_from_vm():
     """Get all readings from VictoriaMetrics for Excel export."""
     try:
         # Start with 30 days of 5-minute data (8640 points max)
-        hours = 30 * 24
-        step = "5m"
-
-        # Collect all data with timestamps as keys for proper alignment
-        all_rows = {}
-
-        for col, metric in VM_METRICS.items():
-            resp = requests.get(
-                f"{VM_URL}/api/v1/query_range",
-                params={
-                    "query": metric,
-                    "start": f"-{hours}h",
-                    "end": "now",
-                    "step": step,
-                },
-                timeout=60
-            )
-            data = resp.json()
-
-            if data.get("status") == "success" and data.get("data", {}).get("result"):
-                values = data["data"]["result"][0]["values"]
-                for ts, val in values:
-                    if ts not in all_rows:
-                        all_rows[ts] = {"timestamp": datetime.fromtimestamp(ts)}
-                    all_rows[ts][col] = float(val)
-
-        if all_rows:
-            # Sort by timestamp and convert to DataFrame
-            sorted_rows = sorted(all_rows.values(), key=lambda x: x["timestamp"])
-            df = pd.DataFrame(sorted_rows)
-            return df
-        return pd.DataFrame()
+        series = query_victoria_multi(30 * 24, step="5m", timeout=60)
+
+        if not series:
+            return pd.DataFrame()
+
+        # Wrap each series' arrays without copying; the DataFrame constructor
+        # aligns them on timestamp (outer join) for proper row alignment
+        columns = {
+            col: pd.Series(series[col]["values"], index=series[col]["timestamps"], copy=False)
+            for col in VM_METRICS
+            if col in series
+        }
+        df = pd.DataFrame(columns).sort_index()
+        df.index = to_local_datetimes(df.index.to_numpy())
+        df.index.name = "timestamp"
+        return df.reset_index()
     except Exception as e:
         app.logger.error(f"Failed to export from VictoriaMetrics: {e}")
         return pd.DataFrame()
@@ -174,14 +296,14 @@ def get_all_readings_from_vm():
 @app.route("/")
 def index():
     """Main dashboard page."""
-    reading, error = get_sensor_reading()
+    reading, error = get_sensor_reading(live=request.args.get("live") == "1")
     return render_template("index.html", reading=reading, error=error, dps_map=DPS_MAP)
 
 
 @app.route("/api/current")
 def api_current():
-    """Get current sensor reading."""
-    reading, error = get_sensor_reading()
+    """Get current sensor reading (add ?live=1 to read the device directly)."""
+    reading, error = get_sensor_reading(live=request.args.get("live") == "1")
     if error:
         return jsonify({"error": error}), 500
     return jsonify(reading)
@@ -190,7 +312,7 @@ def api_current():
 @app.route("/api/history")
 def api_history():
     """Get historical readings from VictoriaMetrics."""
-    hours = request.args.get("hours", 24, type=int)
+    hours = max(1, min(request.args.get("hours", 24, type=int), MAX_HISTORY_HOURS))
 
     result = {
         "timestamps": [],
@@ -203,29 +325,41 @@ def api_history():
         "orp": [],
     }
 
-    # Query each metric
-    for col, metric in VM_METRICS.items():
-        data = query_victoria(metric, hours)
-        if data["timestamps"] and not result["timestamps"]:
-            result["timestamps"] = data["timestamps"]
-        result[col] = data["values"]
+    # Query all metrics at once
+    series = query_victoria_multi(hours)
+    for col in VM_METRICS:
+        data = series.get(col)
+        if data is None:
+            continue
+        if data["timestamps"].size and not result["timestamps"]:
+            timestamps = to_local_datetimes(data["timestamps"])
+            result["timestamps"] = timestamps.strftime("%Y-%m-%d %H:%M:%S").tolist()
+        result[col] = data["values"].tolist()
 
     return jsonify(result)
 
 
+def static_json(body):
+    """Response for a pre-encoded JSON body that is constant for the process lifetime."""
+    response = Response(body, mimetype="application/json")
+    response.headers["Cache-Control"] = "public, max-age=3600"
+    return response
+
+
+# Preset summary never changes while running, so encode it once
+PRESETS_JSON = json.dumps({
+    "current": TANK_TYPE,
+    "presets": {
+        key: {"name": preset["name"], "description": preset["description"]}
+        for key, preset in TANK_PRESETS.items()
+    }
+})
+
+
 @app.route("/api/presets")
 def api_presets():
     """Get available tank type presets."""
-    presets_summary = {}
-    for key, preset in TANK_PRESETS.items():
-        presets_summary[key] = {
-            "name": preset["name"],
-            "description": preset["description"]
-        }
-    return jsonify({
-        "current": TANK_TYPE,
-        "presets": presets_summary
-    })
+    return static_json(PRESETS_JSON)
 
 
 @app.route("/api/ranges")
@@ -235,97 +369,96 @@ def api_ranges():
     if tank_type not in TANK_PRESETS:
         return jsonify({"error": f"Unknown tank type: {tank_type}"}), 404
 
+    response = jsonify(get_ranges(tank_type))
+    response.headers["Cache-Control"] = "max-age=60"
+    return response
+
+
+@ttl_cache(300, cache_if=lambda ranges: any(r.get("dynamic") for r in ranges.values()))
+def get_ranges(tank_type):
+    """Build safe parameter ranges for a tank type.
+
+    The 7-day means move slowly, so results are cached for five minutes.
+    """
     preset = TANK_PRESETS[tank_type]
     ranges = dict(preset["ranges"])
 
     # Calculate dynamic ranges based on 7-day rolling mean
     # This adapts to local water conditions automatically
 
+    # VictoriaMetrics computes the 7-day means server-side in one instant query
+    means = query_victoria_instant(WEEKLY_MEANS_QUERY)
+
     # pH: ±0.5 around mean (stability matters more than absolute value)
-    ph_data = query_victoria(VM_METRICS["ph"], 168)  # 7 days
-    if ph_data["values"]:
-        ph_values = [v for v in ph_data["values"] if v is not None]
-        if ph_values:
-            ph_mean = sum(ph_values) / len(ph_values)
-            ranges["ph"] = {
-                "min": 6.5,  # Absolute low limit
-                "max": 8.5,  # Absolute high limit
-                "ideal_min": max(6.5, ph_mean - 0.5),
-                "ideal_max": min(8.5, ph_mean + 0.5),
-                "unit": "",
-                "dynamic": True,
-                "mean": round(ph_mean, 2)
-            }
+    ph_mean = means.get("ph")
+    if ph_mean is not None:
+        ranges["ph"] = {
+            "min": 6.5,  # Absolute low limit
+            "max": 8.5,  # Absolute high limit
+            "ideal_min": max(6.5, ph_mean - 0.5),
+            "ideal_max": min(8.5, ph_mean + 0.5),
+            "unit": "",
+            "dynamic": True,
+            "mean": round(ph_mean, 2)
+        }
 
     # EC: ±20% around mean (varies with water source)
-    ec_data = query_victoria(VM_METRICS["ec"], 168)
-    if ec_data["values"]:
-        ec_values = [v for v in ec_data["values"] if v is not None]
-        if ec_values:
-            ec_mean = sum(ec_values) / len(ec_values)
-            ranges["ec"] = {
-                "min": max(0, ec_mean * 0.5),    # Absolute: 50% of mean
-                "max": ec_mean * 1.5,             # Absolute: 150% of mean
-                "ideal_min": ec_mean * 0.8,       # Ideal: ±20%
-                "ideal_max": ec_mean * 1.2,
-                "unit": "µS/cm",
-                "dynamic": True,
-                "mean": round(ec_mean, 0)
-            }
+    ec_mean = means.get("ec")
+    if ec_mean is not None:
+        ranges["ec"] = {
+            "min": max(0, ec_mean * 0.5),    # Absolute: 50% of mean
+            "max": ec_mean * 1.5,             # Absolute: 150% of mean
+            "ideal_min": ec_mean * 0.8,       # Ideal: ±20%
+            "ideal_max": ec_mean * 1.2,
+            "unit": "µS/cm",
+            "dynamic": True,
+            "mean": round(ec_mean, 0)
+        }
 
     # TDS: ±20% around mean (tracks with EC)
-    tds_data = query_victoria(VM_METRICS["tds"], 168)
-    if tds_data["values"]:
-        tds_values = [v for v in tds_data["values"] if v is not None]
-        if tds_values:
-            tds_mean = sum(tds_values) / len(tds_values)
-            ranges["tds"] = {
-                "min": max(0, tds_mean * 0.5),
-                "max": tds_mean * 1.5,
-                "ideal_min": tds_mean * 0.8,
-                "ideal_max": tds_mean * 1.2,
-                "unit": "ppm",
-                "dynamic": True,
-                "mean": round(tds_mean, 0)
-            }
+    tds_mean = means.get("tds")
+    if tds_mean is not None:
+        ranges["tds"] = {
+            "min": max(0, tds_mean * 0.5),
+            "max": tds_mean * 1.5,
+            "ideal_min": tds_mean * 0.8,
+            "ideal_max": tds_mean * 1.2,
+            "unit": "ppm",
+            "dynamic": True,
+            "mean": round(tds_mean, 0)
+        }
 
     # Salinity: ±20% around mean (for freshwater, tracks minerals)
-    sal_data = query_victoria(VM_METRICS["salinity"], 168)
-    if sal_data["values"]:
-        sal_values = [v for v in sal_data["values"] if v is not None]
-        if sal_values:
-            sal_mean = sum(sal_values) / len(sal_values)
-            ranges["salinity"] = {
-                "min": max(0, sal_mean * 0.5),
-                "max": sal_mean * 1.5,
-                "ideal_min": sal_mean * 0.8,
-                "ideal_max": sal_mean * 1.2,
-                "unit": "ppm",
-                "dynamic": True,
-                "mean": round(sal_mean, 0)
-            }
+    sal_mean = means.get("salinity")
+    if sal_mean is not None:
+        ranges["salinity"] = {
+            "min": max(0, sal_mean * 0.5),
+            "max": sal_mean * 1.5,
+            "ideal_min": sal_mean * 0.8,
+            "ideal_max": sal_mean * 1.2,
+            "unit": "ppm",
+            "dynamic": True,
+            "mean": round(sal_mean, 0)
+        }
 
     # ORP: ±15% around mean (indicates water quality/oxidation)
-    orp_data = query_victoria(VM_METRICS["orp"], 168)
-    if orp_data["values"]:
-        orp_values = [v for v in orp_data["values"] if v is not None]
-        if orp_values:
-            orp_mean = sum(orp_values) / len(orp_values)
-            ranges["orp"] = {
-                "min": max(0, orp_mean * 0.7),    # Wider absolute range
-                "max": orp_mean * 1.3,
-                "ideal_min": orp_mean * 0.85,     # Tighter ideal: ±15%
-                "ideal_max": orp_mean * 1.15,
-                "unit": "mV",
-                "dynamic": True,
-                "mean": round(orp_mean, 0)
-            }
-
-    return jsonify({
+    orp_mean = means.get("orp")
+    if orp_mean is not None:
+        ranges["orp"] = {
+            "min": max(0, orp_mean * 0.7),    # Wider absolute range
+            "max": orp_mean * 1.3,
+            "ideal_min": orp_mean * 0.85,     # Tighter ideal: ±15%
+            "ideal_max": orp_mean * 1.15,
+            "unit": "mV",
+            "dynamic": True,
+            "mean": round(orp_mean, 0)
+        }
+
+    return {
         "tank_type": tank_type,
         "name": preset["name"],
         "ranges": ranges
-    })
+    }
 
 
 # Common event types with suggested emojis
@@ -343,30 +476,123 @@ EVENT_TYPES = {
     "observation": {"emoji": "👁️", "label": "Observation"},
     "other": {"emoji": "📝", "label": "Note"},
 }
+EVENT_TYPES_JSON = json.dumps(EVENT_TYPES)
 
 
-def load_diary():
-    """Load diary entries from JSON file."""
-    if os.path.exists(DIARY_FILE):
-        try:
-            with open(DIARY_FILE) as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError):
-            return []
-    return []
+DIARY_COLUMNS = "id, timestamp, event_type, emoji, note"
 
+# One SQLite connection per request thread
+_diary_local = threading.local()
 
-def save_diary(entries):
-    """Save diary entries to JSON file."""
-    with open(DIARY_FILE, "w") as f:
-        json.dump(entries, f, indent=2)
+
+def get_diary_db():
+    """Get this thread's connection to the diary database."""
+    conn = getattr(_diary_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DIARY_DB)
+        conn.row_factory = sqlite3.Row
+        _diary_local.conn = conn
+    return conn
+
+
+def timestamp_epoch(timestamp):
+    """Unix time of an ISO timestamp, stored alongside it for age filtering."""
+    try:
+        return datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+
+def init_diary_db():
+    """Create the diary table, importing entries from the old diary.json once."""
+    conn = get_diary_db()
+    conn.execute("PRAGMA journal_mode=WAL")
+    with conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS diary ("
+            "id INTEGER PRIMARY KEY, timestamp TEXT NOT NULL, epoch REAL, "
+            "event_type TEXT, emoji TEXT, note TEXT)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_diary_timestamp ON diary(timestamp DESC)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_diary_epoch ON diary(epoch)")
+
+    if not os.path.exists(DIARY_FILE):
+        return
+    try:
+        with open(DIARY_FILE) as f:
+            entries = json.load(f)
+    except (json.JSONDecodeError, IOError) as e:
+        app.logger.error(f"Could not import {DIARY_FILE}: {e}")
+        return
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO diary (id, timestamp, epoch, event_type, emoji, note) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(e["id"], e["timestamp"], timestamp_epoch(e["timestamp"]),
+              e.get("event_type"), e.get("emoji"), e.get("note", "")) for e in entries]
+        )
+    os.replace(DIARY_FILE, DIARY_FILE + ".migrated")
+
+
+def load_diary(start=None, end=None, since=None):
+    """Load diary entries, most recent first.
+
+    Optionally filter by ISO timestamp bounds (start/end) or by a unix-time
+    cutoff (since).
+    """
+    clauses, params = [], []
+    if since is not None:
+        clauses.append("epoch >= ?")
+        params.append(since)
+    if start:
+        clauses.append("timestamp >= ?")
+        params.append(start)
+    if end:
+        clauses.append("timestamp <= ?")
+        params.append(end)
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    rows = get_diary_db().execute(
+        f"SELECT {DIARY_COLUMNS} FROM diary{where} ORDER BY timestamp DESC", params
+    )
+    return [dict(row) for row in rows]
+
+
+def add_diary_entry(entry):
+    """Insert a diary entry and return the ID SQLite assigned to it."""
+    with get_diary_db() as conn:
+        cursor = conn.execute(
+            "INSERT INTO diary (timestamp, epoch, event_type, emoji, note) VALUES (?, ?, ?, ?, ?)",
+            (entry["timestamp"], timestamp_epoch(entry["timestamp"]),
+             entry["event_type"], entry["emoji"], entry["note"])
+        )
+    return cursor.lastrowid
+
+
+def delete_diary_entry(entry_id):
+    """Delete a diary entry by ID."""
+    with get_diary_db() as conn:
+        conn.execute("DELETE FROM diary WHERE id = ?", (entry_id,))
+
+
+def update_diary_entry(entry_id, changes):
+    """Apply column changes to a diary entry; returns the updated entry or None."""
+    changes = dict(changes)
+    if "timestamp" in changes:
+        changes["epoch"] = timestamp_epoch(changes["timestamp"])
+    with get_diary_db() as conn:
+        if changes:
+            assignments = ", ".join(f"{col} = ?" for col in changes)
+            conn.execute(f"UPDATE diary SET {assignments} WHERE id = ?", (*changes.values(), entry_id))
+        row = conn.execute(f"SELECT {DIARY_COLUMNS} FROM diary WHERE id = ?", (entry_id,)).fetchone()
+    return dict(row) if row else None
+
+
+init_diary_db()
 
 
 @app.route("/api/diary")
 def api_diary_list():
     """Get diary entries, optionally filtered by time range."""
-    entries = load_diary()
-
     # Optional time filtering
     start = request.args.get("start")
     end = request.args.get("end")
@@ -374,16 +600,15 @@ def api_diary_list():
 
     if hours:
         cutoff = datetime.now().timestamp() - (hours * 3600)
-        entries = [e for e in entries if datetime.fromisoformat(e["timestamp"]).timestamp() >= cutoff]
+        entries = load_diary(since=cutoff)
     elif start:
-        entries = [e for e in entries if e["timestamp"] >= start]
-        if end:
-            entries = [e for e in entries if e["timestamp"] <= end]
+        entries = load_diary(start=start, end=end)
+    else:
+        entries = load_diary()
 
-    return jsonify({
-        "entries": entries,
-        "event_types": EVENT_TYPES
-    })
+    # Splice in the pre-encoded event types rather than re-encoding them
+    body = f'{{"entries": {json.dumps(entries)}, "event_types": {EVENT_TYPES_JSON}}}'
+    return Response(body, mimetype="application/json")
 
 
 @app.route("/api/diary", methods=["POST"])
@@ -400,17 +625,13 @@ def api_diary_add():
     emoji = data.get("emoji") or EVENT_TYPES.get(event_type, {}).get("emoji", "📝")
 
     entry = {
-        "id": int(datetime.now().timestamp() * 1000),  # Simple unique ID
         "timestamp": timestamp,
         "event_type": event_type,
         "emoji": emoji,
         "note": note,
     }
 
-    entries = load_diary()
-    entries.append(entry)
-    entries.sort(key=lambda x: x["timestamp"], reverse=True)  # Most recent first
-    save_diary(entries)
+    entry["id"] = add_diary_entry(entry)
 
     return jsonify({"success": True, "entry": entry})
 
@@ -418,9 +639,7 @@ def api_diary_add():
 @app.route("/api/diary/<int:entry_id>", methods=["DELETE"])
 def api_diary_delete(entry_id):
     """Delete a diary entry."""
-    entries = load_diary()
-    entries = [e for e in entries if e["id"] != entry_id]
-    save_diary(entries)
+    delete_diary_entry(entry_id)
     return jsonify({"success": True})
 
 
@@ -428,19 +647,19 @@ def api_diary_delete(entry_id):
 def api_diary_update(entry_id):
     """Update a diary entry."""
     data = request.get_json()
-    entries = load_diary()
-
-    for entry in entries:
-        if entry["id"] == entry_id:
-            if "event_type" in data:
-                entry["event_type"] = data["event_type"]
-                entry["emoji"] = EVENT_TYPES.get(data["event_type"], {}).get("emoji", "📝")
-            if "note" in data:
-                entry["note"] = data["note"]
-            if "timestamp" in data:
-                entry["timestamp"] = data["timestamp"]
-            save_diary(entries)
-            return jsonify({"success": True, "entry": entry})
+
+    changes = {}
+    if "event_type" in data:
+        changes["event_type"] = data["event_type"]
+        changes["emoji"] = EVENT_TYPES.get(data["event_type"], {}).get("emoji", "📝")
+    if "note" in data:
+        changes["note"] = data["note"]
+    if "timestamp" in data:
+        changes["timestamp"] = data["timestamp"]
+
+    entry = update_diary_entry(entry_id, changes)
+    if entry:
+        return jsonify({"success": True, "entry": entry})
 
     return jsonify({"success": False, "error": "Entry not found"}), 404
 
@@ -448,7 +667,18 @@ def api_diary_update(entry_id):
 @app.route("/api/event_types")
 def api_event_types():
     """Get available event types with emojis."""
-    return jsonify(EVENT_TYPES)
+    return static_json(EVENT_TYPES_JSON)
+
+
+def write_sheet(workbook, name, frame, widths, header_format):
+    """Write a DataFrame to a new worksheet one row at a time, as
+    constant_memory mode requires. Missing values become blank cells."""
+    worksheet = workbook.add_worksheet(name)
+    for i, width in enumerate(widths):
+        worksheet.set_column(i, i, width)
+    worksheet.write_row(0, 0, list(frame.columns), header_format)
+    for row, values in enumerate(frame.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row, 0, [None if pd.isna(v) else v for v in values])
 
 
 @app.route("/export/excel")
@@ -489,31 +719,54 @@ def export_excel():
         # Sort by timestamp
         diary_df = diary_df.sort_values("Timestamp", ascending=False)
 
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        # Sensor data sheet
-        df.to_excel(writer, index=False, sheet_name="Sensor Data")
-        worksheet = writer.sheets["Sensor Data"]
-        for i, col in enumerate(df.columns):
-            max_len = max(df[col].astype(str).map(len).max(), len(col)) + 2
-            worksheet.column_dimensions[chr(65 + i)].width = min(max_len, 25)
+    # Rows are written in order, so constant_memory mode can flush each one
+    # to the temp file as soon as the next starts instead of holding the
+    # whole workbook in memory
+    with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as tmp:
+        path = tmp.name
+
+    try:
+        workbook = xlsxwriter.Workbook(path, {
+            "constant_memory": True,
+            "default_date_format": "yyyy-mm-dd hh:mm:ss",
+        })
+        header_format = workbook.add_format({"bold": True, "border": 1, "align": "center"})
+
+        # Sensor data sheet: values are timestamps and numbers, so size
+        # columns from the headers rather than stringifying every cell
+        widths = [20] + [min(max(len(col), 12) + 2, 25) for col in df.columns[1:]]
+        write_sheet(workbook, "Sensor Data", df, widths, header_format)
 
         # Diary sheet
         if not diary_df.empty:
-            diary_df.to_excel(writer, index=False, sheet_name="Diary")
-            worksheet = writer.sheets["Diary"]
-            for i, col in enumerate(diary_df.columns):
-                max_len = max(diary_df[col].astype(str).map(len).max(), len(col)) + 2
-                worksheet.column_dimensions[chr(65 + i)].width = min(max_len, 40)
+            widths = [
+                min(max(diary_df[col].astype(str).map(len).max(), len(col)) + 2, 40)
+                for col in diary_df.columns
+            ]
+            write_sheet(workbook, "Diary", diary_df, widths, header_format)
+
+        workbook.close()
+    except Exception:
+        os.remove(path)
+        raise
+
+    @after_this_request
+    def remove_export(response):
+        try:
+            os.remove(path)
+        except OSError as e:
+            app.logger.error(f"Failed to remove export file {path}: {e}")
+        return response
 
-    output.seek(0)
     filename = f"aquarium_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-    return send_file(
-        output,
+    response = send_file(
+        path,
         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         as_attachment=True,
         download_name=filename
     )
+    response.headers["Cache-Control"] = "max-age=60"
+    return response
 
 
 if __name__ == "__main__":
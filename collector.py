@@ -10,6 +10,8 @@ import time
 import logging
 import requests
 import tinytuya
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Logging setup
 logging.basicConfig(
@@ -28,19 +30,32 @@ if os.path.exists(CONFIG_FILE):
     DEVICE_IP = config.get("device_ip", "")
     LOCAL_KEY = config.get("local_key", "")
     VERSION = config.get("protocol_version", 3.5)
+    FLUSH_CYCLES = config.get("flush_cycles", 1)
 else:
     # Fallback to hardcoded values (for backwards compatibility)
     DEVICE_ID = "bfe0cad26f6fbd00c8v7dn"
     DEVICE_IP = "192.168.0.215"
     LOCAL_KEY = "v.X0.aJ~eBK/5ruE"
     VERSION = 3.5
+    FLUSH_CYCLES = 1
 
 # VictoriaMetrics configuration
 VM_URL = "http://localhost:8428/api/v1/import/prometheus"
 
+# Keep-alive session reused for every write
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(max_retries=Retry(total=2, backoff_factor=0.2)))
+
 # Collection interval (seconds)
 INTERVAL = 300  # 5 minutes
 
+# Samples are buffered and written every FLUSH_CYCLES cycles (default 1, as
+# the dashboard reads the latest sample from VictoriaMetrics). Buffered data
+# is flushed at least hourly, and kept across failed writes up to ~1 day.
+FLUSH_INTERVAL = 3600
+MAX_BUFFER_LINES = 288 * 7  # cycles per day x metrics per cycle
+BUFFER = []
+
 # DPS mappings: dp_id -> (metric_name, scale_factor)
 DPS_MAP = {
     "8": ("aquarium_temperature_celsius", 0.1),
@@ -52,13 +67,27 @@ DPS_MAP = {
     "131": ("aquarium_orp_mv", 1),
 }
 
+# Per-metric Prometheus line templates: dp_id -> (template, scale_factor)
+DPS_TEMPLATES = {
+    dp_id: (name + '{{sensor="seafront_8in1"}} {value} {ts}', scale)
+    for dp_id, (name, scale) in DPS_MAP.items()
+}
+
+# Short names for the log line, e.g. aquarium_ph -> ph
+SHORT_NAMES = {dp_id: name.split('_')[1] for dp_id, (name, _) in DPS_MAP.items()}
+
+
+# Sensor handle, reused between collection cycles. The socket is not kept
+# open: the sensor accepts few local clients, and live reads from the web
+# app and the setup wizard need to connect too
+DEVICE = tinytuya.Device(DEVICE_ID, DEVICE_IP, LOCAL_KEY, version=VERSION)
+DEVICE.set_socketTimeout(10)
+
 
 def get_sensor_reading():
     """Fetch current reading from the aquarium sensor."""
     try:
-        d = tinytuya.Device(DEVICE_ID, DEVICE_IP, LOCAL_KEY, version=VERSION)
-        d.set_socketTimeout(10)
-        result = d.status()
+        result = DEVICE.status()
 
         if "Error" in result:
             log.error(f"Sensor error: {result['Error']}")
@@ -70,25 +99,24 @@ def get_sensor_reading():
         return None
 
 
-def write_to_victoria(dps):
-    """Write metrics to VictoriaMetrics in Prometheus format."""
-    lines = []
+def format_metrics(dps):
+    """Format a sensor reading as Prometheus exposition lines."""
     timestamp_ms = int(time.time() * 1000)
 
-    for dp_id, (metric_name, scale) in DPS_MAP.items():
-        if dp_id in dps:
-            value = dps[dp_id] * scale
-            # Prometheus exposition format: metric_name{labels} value timestamp
-            lines.append(f'{metric_name}{{sensor="seafront_8in1"}} {value} {timestamp_ms}')
+    # Prometheus exposition format: metric_name{labels} value timestamp
+    return [
+        template.format(value=dps[dp_id] * scale, ts=timestamp_ms)
+        for dp_id, (template, scale) in DPS_TEMPLATES.items()
+        if dp_id in dps
+    ]
 
-    if not lines:
-        log.warning("No data points to write")
-        return False
 
+def write_to_victoria(lines):
+    """Write metric lines to VictoriaMetrics in Prometheus format."""
     payload = "\n".join(lines)
 
     try:
-        resp = requests.post(VM_URL, data=payload, timeout=10)
+        resp = SESSION.post(VM_URL, data=payload, timeout=10)
         if resp.status_code == 204:
             log.info(f"Wrote {len(lines)} metrics to VictoriaMetrics")
             return True
@@ -100,17 +128,42 @@ def write_to_victoria(dps):
         return False
 
 
+def flush_buffer():
+    """Write buffered metrics, keeping them for the next attempt on failure."""
+    if not BUFFER:
+        return True
+
+    if write_to_victoria(BUFFER):
+        BUFFER.clear()
+        return True
+
+    if len(BUFFER) > MAX_BUFFER_LINES:
+        dropped = len(BUFFER) - MAX_BUFFER_LINES
+        del BUFFER[:dropped]
+        log.warning(f"Buffer full, dropped {dropped} oldest metrics")
+    return False
+
+
 def collect_once():
-    """Single collection cycle."""
+    """Single collection cycle. Returns True if a sample was buffered."""
     dps = get_sensor_reading()
-    if dps:
-        write_to_victoria(dps)
-        # Log current values
-        readings = []
-        for dp_id, (name, scale) in DPS_MAP.items():
-            if dp_id in dps:
-                readings.append(f"{name.split('_')[1]}={dps[dp_id] * scale:.2f}")
-        log.info(f"Current: {', '.join(readings)}")
+    if not dps:
+        return False
+
+    lines = format_metrics(dps)
+    if not lines:
+        log.warning("No data points to write")
+        return False
+    BUFFER.extend(lines)
+
+    # Log current values
+    readings = [
+        f"{SHORT_NAMES[dp_id]}={dps[dp_id] * scale:.2f}"
+        for dp_id, (_, scale) in DPS_MAP.items()
+        if dp_id in dps
+    ]
+    log.info(f"Current: {', '.join(readings)}")
+    return True
 
 
 def main():
@@ -118,9 +171,17 @@ def main():
     log.info(f"Starting aquarium collector (interval: {INTERVAL}s)")
     log.info(f"Device: {DEVICE_IP}, VictoriaMetrics: {VM_URL}")
 
+    buffered_cycles = 0
+    last_flush = time.time()
+
     while True:
         try:
-            collect_once()
+            if collect_once():
+                buffered_cycles += 1
+            if buffered_cycles >= FLUSH_CYCLES or time.time() - last_flush >= FLUSH_INTERVAL:
+                if flush_buffer():
+                    buffered_cycles = 0
+                    last_flush = time.time()
         except Exception as e:
             log.error(f"Collection error: {e}")
 
@@ -0,0 +1,15 @@
+"""
+Gunicorn configuration for the Aquarium Monitor web interface.
+Run with: gunicorn -c gunicorn.conf.py app:app
+"""
+
+bind = "192.168.0.180:5000"
+
+# Handlers mostly wait on the sensor and VictoriaMetrics, so threads give the
+# concurrency. A single worker process keeps the in-memory caches shared.
+workers = 1
+worker_class = "gthread"
+threads = 8
+
+# Sensor reads can take several seconds and the 30-day export longer
+timeout = 120
@@ -2,164 +2,361 @@
 """
 Tuya Device Setup Wizard
 Guides users through obtaining device credentials for local access.
+
+Run with --refresh to ignore the cached cloud device list.
 """
 
 import os
+import re
 import sys
 import json
+import time
+import select
+import socket
+import hashlib
+import asyncio
+import ipaddress
+
+try:
+    import tinytuya
+except ImportError:
+    tinytuya = None
+
+# Optional: lets discovery reach every network interface, not just the default route
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# orjson is much faster on large device lists; fall back to the stdlib
+try:
+    import orjson
+
+    def json_dumps(obj, indent=False):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj, indent=False):
+        return json.dumps(obj, indent=2 if indent else None).encode()
+
+    json_loads = json.loads
 
 CONFIG_FILE = os.path.join(os.path.dirname(__file__), "config.json")
 
+# Heuristics for spotting water quality monitors in the cloud device list
+AQUARIUM_CATEGORIES = frozenset(('dgnbj', 'wsdcg'))
+AQUARIUM_NAME_RE = re.compile(r'water|aqua|ph', re.IGNORECASE)
+
+# Cloud device lists are cached so re-running the wizard doesn't hit
+# Tuya's API rate limits
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "aquarium-monitor")
+MANIFEST_TTL = 3600  # 1 hour
+
+# Device list written by tinytuya's own wizard (python -m tinytuya wizard)
+TINYTUYA_DEVICES_FILE = os.path.join(os.path.dirname(__file__), "devices.json")
+
+# Local protocol versions to try, newest first
+PROTOCOL_VERSIONS = (3.5, 3.4, 3.3, 3.1)
+
+# Probe timeouts scale with the measured round trip to the device's local port
+TUYA_PORT = 6668
+PROBE_TIMEOUT_MIN = 2
+PROBE_TIMEOUT_MAX = 10
+
+# Tuya devices announce themselves on these UDP ports (plaintext, encrypted)
+DISCOVERY_PORTS = (6666, 6667)
+
+# Newer (3.5) devices only announce when asked; requests and replies use this port
+APP_DISCOVERY_PORT = 7000
+SCAN_TIMEOUT = 20  # Upper bound on a scan, as with tinytuya.deviceScan
+SCAN_SETTLE = 6    # Keep listening this long after the first device is heard
+
+# Static text for each wizard step, written out in one go
+HEADER = f"""
+{"=" * 60}
+  Aquarium Monitor - Tuya Device Setup
+{"=" * 60}
+
+"""
+
+INTRO = """\
+This wizard will help you set up local access to your
+Tuya-based aquarium sensor (SEAFRONT, YIERYI, etc.)
+
+You will need:
+  • A Tuya IoT Platform account (free)
+  • The Smart Life or Tuya Smart app with your device paired
+  • Your aquarium sensor on the same network as this computer
+
+"""
+
+ACCOUNT_HELP = """\
+1. Go to: https://iot.tuya.com/
+2. Click 'Start Free Trial' or 'Log In'
+3. Create an account (or use Google/GitHub login)
+
+"""
+
+PROJECT_HELP = """\
+1. Go to: Cloud → Development
+2. Click 'Create Cloud Project'
+3. Fill in:
+   - Project Name: Aquarium Monitor (or anything)
+   - Industry: Smart Home
+   - Development Method: Smart Home
+   - Data Center: Select your region:
+       • Western Europe - UK, Ireland, Portugal
+       • Central Europe - Germany, France, etc.
+       • US West / US East - Americas
+       • India - South Asia
+       • China - China only
+
+   TIP: If unsure, try Central Europe first for EU users.
+
+"""
+
+CREDENTIALS_HELP = """\
+1. Click on your project name
+2. You'll see 'Access ID/Client ID' and 'Access Secret/Client Secret'
+3. Copy these values:
+
+"""
+
+REGION_HELP = """
+4. Select your data center region:
+   eu     - Europe
+   us     - United States
+   cn     - China
+   in     - India
+
+"""
+
+SERVICES_HELP = """\
+1. In your project, go to 'Service API' tab
+2. Click 'Go to Authorize' for each of these:
+   - IoT Core
+   - Authorization Token Management
+   - Smart Home Scene Linkage (if available)
+3. Subscribe to each (they're free)
+
+"""
+
+LINK_HELP = """\
+1. In your project, go to 'Devices' tab
+2. Click 'Link Tuya App Account'
+3. A QR code will appear
+4. On your phone (Smart Life or Tuya Smart app):
+   - Go to 'Me' tab
+   - Tap the scan icon (top right)
+   - Scan the QR code
+5. Confirm the linking
+
+NOTE: The app account must be the one that has the
+      aquarium sensor paired to it!
+
+If you get 'Data centers inconsistency' error:
+  → Change the data center in the top-right dropdown
+  → Try: Central Europe for UK accounts
+
+"""
+
+COMPLETE = f"""
+{"=" * 60}
+  Setup Complete!
+{"=" * 60}
+
+Next steps:
+  1. Run: sudo ./install.sh
+  2. Access dashboard at: http://<your-ip>:5000
+
+"""
+
+
 def print_header():
-    print()
-    print("=" * 60)
-    print("  Aquarium Monitor - Tuya Device Setup")
-    print("=" * 60)
-    print()
+    sys.stdout.write(HEADER)
+
+def tinytuya_missing():
+    """Print install instructions if tinytuya isn't available."""
+    if tinytuya is None:
+        print("Error: tinytuya not installed")
+        print("Run: pip install tinytuya")
+        return True
+    return False
 
 def print_step(num, title):
-    print()
-    print(f"─── Step {num}: {title} ───")
-    print()
+    sys.stdout.write(f"\n─── Step {num}: {title} ───\n\n")
+
+def read_line(prompt=""):
+    """Read a line from the user, like input().
+
+    On a POSIX terminal stdin is drained in non-blocking chunks, so a pasted
+    API secret arrives in one read; elsewhere this falls back to input().
+    """
+    if os.name != "posix" or not sys.stdin.isatty():
+        return input(prompt)
+
+    sys.stdout.write(prompt)
+    sys.stdout.flush()
+
+    fd = sys.stdin.fileno()
+    was_blocking = os.get_blocking(fd)
+    data = b""
+    os.set_blocking(fd, False)
+    try:
+        while not data.endswith(b"\n"):
+            select.select([fd], [], [])
+            try:
+                chunk = os.read(fd, 4096)
+            except BlockingIOError:
+                continue
+            if not chunk:
+                raise EOFError
+            data += chunk
+    finally:
+        os.set_blocking(fd, was_blocking)
+
+    return data.decode(errors="replace").split("\n", 1)[0].rstrip("\r")
 
 def get_input(prompt, default=None):
     if default:
-        result = input(f"{prompt} [{default}]: ").strip()
+        result = read_line(f"{prompt} [{default}]: ").strip()
         return result if result else default
-    return input(f"{prompt}: ").strip()
+    return read_line(f"{prompt}: ").strip()
 
 def setup_tuya_cloud():
     print_step(1, "Create Tuya IoT Platform Account")
-    print("1. Go to: https://iot.tuya.com/")
-    print("2. Click 'Start Free Trial' or 'Log In'")
-    print("3. Create an account (or use Google/GitHub login)")
-    print()
-    input("Press Enter when done...")
+    sys.stdout.write(ACCOUNT_HELP)
+    read_line("Press Enter when done...")
 
     print_step(2, "Create a Cloud Project")
-    print("1. Go to: Cloud → Development")
-    print("2. Click 'Create Cloud Project'")
-    print("3. Fill in:")
-    print("   - Project Name: Aquarium Monitor (or anything)")
-    print("   - Industry: Smart Home")
-    print("   - Development Method: Smart Home")
-    print("   - Data Center: Select your region:")
-    print("       • Western Europe - UK, Ireland, Portugal")
-    print("       • Central Europe - Germany, France, etc.")
-    print("       • US West / US East - Americas")
-    print("       • India - South Asia")
-    print("       • China - China only")
-    print()
-    print("   TIP: If unsure, try Central Europe first for EU users.")
-    print()
-    input("Press Enter when done...")
+    sys.stdout.write(PROJECT_HELP)
+    read_line("Press Enter when done...")
 
     print_step(3, "Get API Credentials")
-    print("1. Click on your project name")
-    print("2. You'll see 'Access ID/Client ID' and 'Access Secret/Client Secret'")
-    print("3. Copy these values:")
-    print()
+    sys.stdout.write(CREDENTIALS_HELP)
 
     api_key = get_input("Access ID/Client ID")
     api_secret = get_input("Access Secret/Client Secret")
 
-    print()
-    print("4. Select your data center region:")
-    print("   eu     - Europe")
-    print("   us     - United States")
-    print("   cn     - China")
-    print("   in     - India")
-    print()
+    sys.stdout.write(REGION_HELP)
     api_region = get_input("Region code", "eu")
 
     print_step(4, "Subscribe to API Services")
-    print("1. In your project, go to 'Service API' tab")
-    print("2. Click 'Go to Authorize' for each of these:")
-    print("   - IoT Core")
-    print("   - Authorization Token Management")
-    print("   - Smart Home Scene Linkage (if available)")
-    print("3. Subscribe to each (they're free)")
-    print()
-    input("Press Enter when done...")
+    sys.stdout.write(SERVICES_HELP)
+    read_line("Press Enter when done...")
 
     print_step(5, "Link Your Smart Life App")
-    print("1. In your project, go to 'Devices' tab")
-    print("2. Click 'Link Tuya App Account'")
-    print("3. A QR code will appear")
-    print("4. On your phone (Smart Life or Tuya Smart app):")
-    print("   - Go to 'Me' tab")
-    print("   - Tap the scan icon (top right)")
-    print("   - Scan the QR code")
-    print("5. Confirm the linking")
-    print()
-    print("NOTE: The app account must be the one that has the")
-    print("      aquarium sensor paired to it!")
-    print()
-    print("If you get 'Data centers inconsistency' error:")
-    print("  → Change the data center in the top-right dropdown")
-    print("  → Try: Central Europe for UK accounts")
-    print()
-    input("Press Enter when your device appears in the Devices tab...")
+    sys.stdout.write(LINK_HELP)
+    read_line("Press Enter when your device appears in the Devices tab...")
 
     return api_key, api_secret, api_region
 
 
-def fetch_device_info(api_key, api_secret, api_region):
-    print_step(6, "Fetching Device Information")
+def manifest_path(api_key, api_region):
+    """Cache file for the device list of one set of cloud credentials."""
+    digest = hashlib.sha256(f"{api_key}:{api_region}".encode()).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f"devices-{digest}.json")
 
+
+def load_cached_devices(path):
+    """Load a cached device list, or None if missing or older than MANIFEST_TTL."""
     try:
-        import tinytuya
-    except ImportError:
-        print("Error: tinytuya not installed")
-        print("Run: pip install tinytuya")
+        if time.time() - os.stat(path).st_mtime > MANIFEST_TTL:
+            return None
+        with open(path, "rb") as f:
+            return json_loads(f.read())
+    except (OSError, ValueError):
         return None
 
-    # Write temp config for tinytuya
-    config = {
-        "apiKey": api_key,
-        "apiSecret": api_secret,
-        "apiRegion": api_region,
-        "apiDeviceID": "All"
-    }
 
-    temp_config = os.path.join(os.path.dirname(__file__), "tinytuya.json")
-    with open(temp_config, "w") as f:
-        json.dump(config, f)
+def write_atomic(path, data, mode=0o666):
+    """Write bytes to `path` via a synced temp file and os.replace, so a crash
+    never leaves it half-written. `mode` is filtered by the umask as usual."""
+    tmp = path + ".tmp"
+    try:
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
 
-    print("Connecting to Tuya Cloud...")
-    print()
+def save_cached_devices(path, devices):
+    """Write a device list to the cache (it holds local keys, so owner-only)."""
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        write_atomic(path, json_dumps(devices), mode=0o600)
+    except OSError as e:
+        print(f"Warning: could not cache device list: {e}")
+
+
+def load_cloud_devices(api_key, api_secret, api_region, refresh=False):
+    """Return the account's cloud device list, from the cache when fresh.
+    Non-interactive so it can run in a worker thread alongside the scan."""
+    cache_file = manifest_path(api_key, api_region)
+    if not refresh:
+        cached = load_cached_devices(cache_file) or load_cached_devices(TINYTUYA_DEVICES_FILE)
+        if isinstance(cached, list) and cached:
+            print("Using cached device list (run with --refresh to fetch again)")
+            return cached
+
+    # Use tinytuya's cloud API directly
+    cloud = tinytuya.Cloud(
+        apiRegion=api_region,
+        apiKey=api_key,
+        apiSecret=api_secret
+    )
+    devices = cloud.getdevices()
+    if isinstance(devices, list) and devices:
+        save_cached_devices(cache_file, devices)
+    return devices
+
+
+async def discover(api_key, api_secret, api_region, refresh=False):
+    """Fetch the cloud device list while listening for local broadcasts.
+    Returns (devices, scanned); either may be the exception it raised."""
+    return await asyncio.gather(
+        asyncio.to_thread(load_cloud_devices, api_key, api_secret, api_region, refresh),
+        listen_for_devices(),
+        return_exceptions=True
+    )
+
+
+def fetch_device_info(devices):
+    # Fetched once; the manual Device ID fallback below reuses this index
+    by_id = {}
 
     try:
-        import tinytuya.wizard as wizard
-        # Use tinytuya's cloud API directly
-        cloud = tinytuya.Cloud(
-            apiRegion=api_region,
-            apiKey=api_key,
-            apiSecret=api_secret
-        )
+        if isinstance(devices, Exception):
+            raise devices
 
-        devices = cloud.getdevices()
+        if isinstance(devices, list):
+            by_id = {dev.get('id'): dev for dev in devices if isinstance(dev, dict)}
 
         if not devices:
             print("No devices found. Make sure you've linked your app account.")
             return None
 
-        print(f"Found {len(devices)} device(s):")
-        print()
-
+        # Build the listing and filter in one pass, then write it out at once
+        lines = [f"Found {len(devices)} device(s):\n"]
         aquarium_devices = []
         for i, dev in enumerate(devices):
             name = dev.get('name', 'Unknown')
             dev_id = dev.get('id', '')
             category = dev.get('category', '')
-            print(f"  {i+1}. {name}")
-            print(f"     ID: {dev_id}")
-            print(f"     Category: {category}")
-            print()
+            lines.append(f"  {i+1}. {name}\n     ID: {dev_id}\n     Category: {category}\n")
 
             # Look for water quality monitors
-            if category in ['dgnbj', 'wsdcg'] or 'water' in name.lower() or 'aqua' in name.lower() or 'ph' in name.lower():
+            if category in AQUARIUM_CATEGORIES or AQUARIUM_NAME_RE.search(name):
                 aquarium_devices.append(dev)
+        sys.stdout.write("\n".join(lines) + "\n")
 
         if not aquarium_devices:
             aquarium_devices = devices
@@ -167,9 +364,14 @@ def fetch_device_info(api_key, api_secret, api_region):
         if len(aquarium_devices) == 1:
             selected = aquarium_devices[0]
         else:
+            # Numbers in the listing above cover every device, not just matches
             print("Select your aquarium sensor (enter number):")
-            choice = int(input("> ")) - 1
-            selected = devices[choice]
+            while True:
+                raw = read_line("> ").strip()
+                if raw.isdigit() and 1 <= int(raw) <= len(devices):
+                    break
+                print(f"Enter a number from 1 to {len(devices)}")
+            selected = devices[int(raw) - 1]
 
         return {
             "device_id": selected.get('id'),
@@ -186,77 +388,195 @@ def fetch_device_info(api_key, api_secret, api_region):
         print()
         device_id = get_input("Device ID")
 
-        # Try to get local key via API
+        # Look up the local key in the device list already fetched
+        dev = by_id.get(device_id)
+        if dev:
+            return {
+                "device_id": device_id,
+                "local_key": dev.get('key'),
+                "name": dev.get('name', 'Aquarium Sensor'),
+                "ip": dev.get('ip', '')
+            }
+
+        return {"device_id": device_id, "local_key": None, "name": "Aquarium Sensor", "ip": ""}
+
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    """Collects Tuya UDP broadcasts into `devices`, resolving `done` once the
+    wanted device is heard (or SCAN_SETTLE seconds after the first device
+    when no ID is wanted)."""
+
+    def __init__(self, devices, done, device_id=None):
+        self.devices = devices
+        self.done = done
+        self.device_id = device_id
+
+    def datagram_received(self, data, addr):
         try:
-            cloud = tinytuya.Cloud(
-                apiRegion=api_region,
-                apiKey=api_key,
-                apiSecret=api_secret
+            info = json_loads(tinytuya.decrypt_udp(data))
+        except Exception:
+            return
+        if not isinstance(info, dict) or info.get('from') == 'app':
+            return  # our own discovery request echoed back
+
+        first = not self.devices
+        self.devices[info.get('ip') or addr[0]] = info
+
+        if self.done.done():
+            return
+        if self.device_id:
+            if info.get('gwId') == self.device_id:
+                self.done.set_result(None)
+        elif first:
+            asyncio.get_running_loop().call_later(SCAN_SETTLE, self.finish)
+
+    def finish(self):
+        if not self.done.done():
+            self.done.set_result(None)
+
+
+def broadcast_addresses():
+    """Return {local address: broadcast address} for each IPv4 interface."""
+    if psutil is None:
+        return {'0.0.0.0': '255.255.255.255'}
+
+    nets = {}
+    for addrs in psutil.net_if_addrs().values():
+        for addr in addrs:
+            if addr.family != socket.AF_INET or addr.address.startswith('127.'):
+                continue
+            broadcast = addr.broadcast
+            if not broadcast and addr.netmask:
+                network = ipaddress.IPv4Network(f"{addr.address}/{addr.netmask}", strict=False)
+                broadcast = str(network.broadcast_address)
+            nets[addr.address] = broadcast or '255.255.255.255'
+
+    return nets or {'0.0.0.0': '255.255.255.255'}
+
+
+def send_discovery_requests():
+    """Broadcast a discovery request out of every interface so devices on a
+    subnet other than the default route still announce themselves."""
+    for address, broadcast in broadcast_addresses().items():
+        try:
+            payload = json_dumps({"from": "app", "ip": address})
+            msg = tinytuya.TuyaMessage(
+                0, tinytuya.REQ_DEVINFO, None, payload, 0, True, tinytuya.PREFIX_6699_VALUE, True
+            )
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                sock.bind((address, 0))
+                sock.sendto(
+                    tinytuya.pack_message(msg, hmac_key=tinytuya.udpkey),
+                    (broadcast, APP_DISCOVERY_PORT)
+                )
+        except Exception:
+            # Older tinytuya or an interface that can't broadcast; passive
+            # listening still picks up devices that announce on their own
+            continue
+
+
+async def listen_for_devices(device_id=None, timeout=SCAN_TIMEOUT):
+    """Listen for Tuya broadcasts and return {ip: info} for each device heard."""
+    loop = asyncio.get_running_loop()
+    devices = {}
+    done = loop.create_future()
+    transports = []
+
+    try:
+        for port in DISCOVERY_PORTS + (APP_DISCOVERY_PORT,):
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: DiscoveryProtocol(devices, done, device_id),
+                local_addr=('0.0.0.0', port),
+                reuse_port=True,
+                allow_broadcast=True
             )
-            result = cloud.getdevices()
-            for dev in result:
-                if dev.get('id') == device_id:
-                    return {
-                        "device_id": device_id,
-                        "local_key": dev.get('key'),
-                        "name": dev.get('name', 'Aquarium Sensor'),
-                        "ip": dev.get('ip', '')
-                    }
-        except:
+            transports.append(transport)
+        send_discovery_requests()
+        try:
+            await asyncio.wait_for(done, timeout)
+        except asyncio.TimeoutError:
             pass
+    finally:
+        for transport in transports:
+            transport.close()
 
-        return {"device_id": device_id, "local_key": None, "name": "Aquarium Sensor", "ip": ""}
+    return devices
 
 
-def scan_network():
-    print_step(7, "Scanning Network for Device")
+def broadcast_ip(devices, device_id):
+    """Address a scan heard `device_id` broadcasting from, or ''."""
+    return next((ip for ip, info in devices.items() if info.get('gwId') == device_id), '')
 
-    try:
-        import tinytuya
-        print("Scanning local network for Tuya devices...")
-        print("(This may take 20 seconds)")
-        print()
 
-        devices = tinytuya.deviceScan(verbose=False)
+def find_device_ip(device_id):
+    """Listen for one device's broadcast, stopping as soon as it is heard."""
+    print_step(7, "Scanning Network for Device")
+    print("Listening for your device on the local network...")
+    print(f"(This may take up to {SCAN_TIMEOUT} seconds)")
+    print()
 
-        if devices:
-            print(f"Found {len(devices)} Tuya device(s) on network:")
-            for ip, info in devices.items():
-                print(f"  {ip}: {info.get('gwId', 'unknown')}")
-            return devices
-        else:
-            print("No devices found via broadcast.")
-            print("The device may not broadcast, but can still work if you know its IP.")
+    try:
+        ip = broadcast_ip(asyncio.run(listen_for_devices(device_id)), device_id)
     except Exception as e:
         print(f"Scan error: {e}")
+        return ''
+
+    if not ip:
+        print("Device not found via broadcast.")
+        print("The device may not broadcast, but can still work if you know its IP.")
+    return ip
 
-    return {}
+
+def measure_rtt(ip):
+    """Time a TCP connect to the device's local port; None if it's unreachable."""
+    start = time.perf_counter()
+    try:
+        with socket.create_connection((ip, TUYA_PORT), timeout=PROBE_TIMEOUT_MAX):
+            pass
+    except OSError:
+        return None
+    return time.perf_counter() - start
 
 
 def test_connection(device_id, local_key, ip):
     print()
     print("Testing connection to device...")
+    if tinytuya_missing():
+        return None, {}
+
+    # An empty or unspecified address would connect to this machine instead
+    try:
+        valid = not ipaddress.ip_address(ip).is_unspecified
+    except ValueError:
+        valid = False
+    if not valid:
+        print(f"✗ No usable device IP ({ip or 'none given'}); skipping connection test")
+        return None, {}
+
+    # Size the probe timeout from the real round trip instead of a fixed 10s,
+    # so mismatched versions give up quickly on a fast LAN
+    rtt = measure_rtt(ip)
+    if rtt is None:
+        print(f"✗ Device not reachable at {ip}:{TUYA_PORT}")
+        return None, {}
+    timeout = min(PROBE_TIMEOUT_MAX, max(PROBE_TIMEOUT_MIN, rtt * 50))
 
     try:
-        import tinytuya
-        d = tinytuya.Device(device_id, ip, local_key, version=3.5)
-        d.set_socketTimeout(10)
-        result = d.status()
-
-        if "Error" in result:
-            # Try other versions
-            for ver in [3.4, 3.3, 3.1]:
-                d = tinytuya.Device(device_id, ip, local_key, version=ver)
-                d.set_socketTimeout(10)
-                result = d.status()
-                if "dps" in result:
-                    print(f"✓ Connected successfully (protocol v{ver})")
-                    return ver, result
-            print(f"✗ Connection failed: {result.get('Error')}")
-            return None, result
-
-        print("✓ Connected successfully (protocol v3.5)")
-        return 3.5, result
+        # One version at a time: many devices accept only one local client,
+        # so concurrent probes can lock out the version that would answer
+        d = tinytuya.Device(device_id, ip, local_key, version=PROTOCOL_VERSIONS[0])
+        d.set_socketTimeout(timeout)
+        result = {}
+        for ver in PROTOCOL_VERSIONS:
+            d.set_version(ver)
+            result = d.status()
+            if "dps" in result:
+                print(f"✓ Connected successfully (protocol v{ver})")
+                return ver, result
+
+        print(f"✗ Connection failed: {result.get('Error')}")
+        return None, result
 
     except Exception as e:
         print(f"✗ Connection error: {e}")
@@ -264,31 +584,37 @@ def test_connection(device_id, local_key, ip):
 
 
 def save_config(config):
-    with open(CONFIG_FILE, "w") as f:
-        json.dump(config, f, indent=2)
+    write_atomic(CONFIG_FILE, json_dumps(config, indent=True))
     print(f"Configuration saved to: {CONFIG_FILE}")
 
 
 def main():
     print_header()
+    sys.stdout.write(INTRO)
 
-    print("This wizard will help you set up local access to your")
-    print("Tuya-based aquarium sensor (SEAFRONT, YIERYI, etc.)")
-    print()
-    print("You will need:")
-    print("  • A Tuya IoT Platform account (free)")
-    print("  • The Smart Life or Tuya Smart app with your device paired")
-    print("  • Your aquarium sensor on the same network as this computer")
-    print()
-
-    proceed = input("Ready to begin? (Y/n): ").strip().lower()
+    proceed = read_line("Ready to begin? (Y/n): ").strip().lower()
     if proceed == 'n':
         print("Setup cancelled.")
         return
 
-    # Get cloud credentials and device info
+    # Get cloud credentials, then fetch devices and scan the network together
     api_key, api_secret, api_region = setup_tuya_cloud()
-    device_info = fetch_device_info(api_key, api_secret, api_region)
+    refresh = "--refresh" in sys.argv[1:]
+
+    print_step(6, "Fetching Device Information")
+    if tinytuya_missing():
+        print("Failed to get device information. Please try again.")
+        return
+
+    print("Connecting to Tuya Cloud and scanning the local network...")
+    print(f"(This may take up to {SCAN_TIMEOUT} seconds)")
+    print()
+
+    devices, scanned = asyncio.run(discover(api_key, api_secret, api_region, refresh))
+    if isinstance(scanned, Exception):
+        print(f"Scan error: {scanned}")
+        scanned = {}
+    device_info = fetch_device_info(devices)
 
     if not device_info:
         print("Failed to get device information. Please try again.")
@@ -299,7 +625,16 @@ def main():
     print(f"ID: {device_info['device_id']}")
     print(f"Local Key: {device_info['local_key']}")
 
-    # Get device IP
+    # Get device IP, preferring the address it broadcast from
+    if not device_info.get('ip'):
+        device_info['ip'] = broadcast_ip(scanned, device_info['device_id'])
+        if not device_info['ip'] and device_info['device_id']:
+            # The first scan settles soon after any device is heard, so
+            # listen again for this one; it ends as soon as it broadcasts
+            device_info['ip'] = find_device_ip(device_info['device_id'])
+        if device_info['ip']:
+            print(f"Found device on network at {device_info['ip']}")
+
     if not device_info.get('ip'):
         print()
         print("Enter the device's IP address.")
@@ -339,15 +674,7 @@ def main():
     print()
     save_config(config)
 
-    print()
-    print("=" * 60)
-    print("  Setup Complete!")
-    print("=" * 60)
-    print()
-    print("Next steps:")
-    print("  1. Run: sudo ./install.sh")
-    print("  2. Access dashboard at: http://<your-ip>:5000")
-    print()
+    sys.stdout.write(COMPLETE)
 
 
 if __name__ == "__main__":